@@ -1,6 +1,10 @@
 import os
+import asyncio
 from concurrent import futures
 import logging
+import queue
+import threading
+import time
 
 import grpc
 import abstractive_summarize_pb2
@@ -9,26 +13,77 @@ import abstractive_summarize_pb2_grpc
 
 from summarizer import Summarizer
 
+MAX_BATCH_REQUESTS = 4 # requests summarized together in one generate call
+BATCH_WINDOW_SECONDS = 0.005 # how long to wait for more requests before running a batch
+
 class AbstractiveSummarizer(abstractive_summarize_pb2_grpc.AbstractiveSummarizerServicer):
     def __init__(self):
         self.summarizer = Summarizer()
+        # The model is a single GPU resource: gRPC handlers only queue requests, one inference thread batches and runs them
+        self.request_queue = queue.Queue()
+        self.inference_thread = threading.Thread(target=self._inference_loop, daemon=True)
+        self.inference_thread.start()
+
+    def _inference_loop(self):
+        while True:
+            batch = [self.request_queue.get()]
+            deadline = time.monotonic() + BATCH_WINDOW_SECONDS
+            while len(batch) < MAX_BATCH_REQUESTS:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.request_queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            # Requests whose RPC was cancelled while queued are dropped; the rest can no longer be cancelled
+            batch = [item for item in batch if item[2].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            try:
+                # Failures are caught per document, so one failing request only fails its own RPC
+                results = self.summarizer.summarize_batch([(document, targets) for document, targets, _ in batch])
+            except Exception as e:
+                for _, _, future in batch:
+                    self._resolve(future, exception=e)
+                continue
+            for (_, _, future), result in zip(batch, results):
+                if isinstance(result, Exception):
+                    self._resolve(future, exception=result)
+                else:
+                    self._resolve(future, result=result)
+
+    @staticmethod
+    def _resolve(future, result=None, exception=None):
+        # Nothing raised here may end the inference loop, or every later request would hang
+        try:
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+        except futures.InvalidStateError as e:
+            print(f"Could not resolve request: {e}")
 
-    def AbstractiveSummarize(self, request: abstractive_summarize_pb2.SummarizationRequest, context):
-        summaries_list = self.summarizer.summarize(request.document, request.targets)
-        summaries = []
-        for summary in summaries_list:
-            summaries.append(abstractive_summarize_pb2.Summary(target_uuid=summary["target_uuid"], summary=summary["summary"]))
-        return abstractive_summarize_pb2.Summaries(summaries=summaries)
+    async def AbstractiveSummarize(self, request: abstractive_summarize_pb2.SummarizationRequest, context):
+        future = futures.Future()
+        self.request_queue.put((request.document, request.targets, future))
+        # Wait without blocking the event loop, so other requests keep being received and queued
+        summaries_list = await asyncio.wrap_future(future)
+        return abstractive_summarize_pb2.Summaries(summaries=[
+            abstractive_summarize_pb2.Summary(target_uuid=summary["target_uuid"], summary=summary["summary"])
+            for summary in summaries_list])
 
-def serve():
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
+async def serve():
+    server = grpc.aio.server(compression=grpc.Compression.Gzip)
     abstractive_summarize_pb2_grpc.add_AbstractiveSummarizerServicer_to_server(AbstractiveSummarizer(), server)
     server.add_insecure_port('[::]:' + os.environ['SERVICE_PORT'])
-    server.start()
+    await server.start()
     print(f"Server started, listening on {os.environ['SERVICE_PORT']}")
-    server.wait_for_termination()
+    await server.wait_for_termination()
 
 
 if __name__ == '__main__':
     logging.basicConfig()
-    serve()
+    asyncio.run(serve())
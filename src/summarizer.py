@@ -1,7 +1,8 @@
-from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
+from transformers import AutoTokenizer, AutoModelForSeq2SeqLM, LogitsProcessor, LogitsProcessorList
 import os
-from typing import List
-from collections import defaultdict
+import re
+from typing import List, Dict, Tuple, Union
+from collections import defaultdict, Counter
 import torch
 
 from unlimiformer import Unlimiformer
@@ -9,9 +10,52 @@ from usage import UnlimiformerArguments
 
 SUMMARY_MODEL_PATH = os.environ['SUMMARY_MODEL_PATH']
 
+NUM_BEAMS = 4
+MAX_BATCH_ROWS = 4 # targets per generate call, bounds the GPU memory of a request with many targets
+GENERATION_KWARGS = {
+    'max_new_tokens': 1024,
+    'num_beams': NUM_BEAMS,
+    'early_stopping': True, # stop beam search once NUM_BEAMS finished hypotheses are found
+    'num_return_sequences': 1,
+    'do_sample': False,
+    'encoder_repetition_penalty': 1.5 # penalise if output token not seen in enconder input
+}
+WARMUP_INPUT_LENGTH = 1024
+WARMUP_NEW_TOKENS = 32
+# What follows the forced "[1] <entity>:" prefix, the summary ending at the next "[n]" entity or line break
+SUMMARY_PATTERN = re.compile(r'\s*(?P<summ>[^\n\[]*)')
+
+class TargetPrefixLogitsProcessor(LogitsProcessor):
+    """
+    Forces every row of a batched generate to start its output with its own token prefix.
+    `force_words_ids` applies the same constraint to the whole batch, so it cannot be used when each row summarizes a different target.
+    """
+    def __init__(self, prefix_ids: List[List[int]], num_beams: int, start_len: int):
+        max_len = max(len(ids) for ids in prefix_ids)
+        # Prefixes padded to a (batch * beam, max_len) table once, so every step is a single masked scatter
+        self.prefix_tokens = torch.tensor([ids + [0] * (max_len - len(ids)) for ids in prefix_ids]).repeat_interleave(num_beams, dim=0)
+        self.prefix_lengths = torch.tensor([len(ids) for ids in prefix_ids]).repeat_interleave(num_beams)
+        self.start_len = start_len # number of decoder tokens (e.g. decoder start + forced BOS) before the prefix begins
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        step = input_ids.shape[-1] - self.start_len
+        if step < 0 or step >= self.prefix_tokens.shape[-1]:
+            return scores
+        if self.prefix_tokens.device != scores.device:
+            self.prefix_tokens = self.prefix_tokens.to(scores.device)
+            self.prefix_lengths = self.prefix_lengths.to(scores.device)
+        forced_scores = torch.full_like(scores, -float("inf")).scatter_(1, self.prefix_tokens[:, step:step + 1], 0)
+        is_forced = (self.prefix_lengths > step).unsqueeze(-1) # (batch * beam, 1)
+        return torch.where(is_forced, forced_scores, scores)
+
 class Summarizer():
     def __init__(self):
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        # Decoding is bound by streaming weights and the KV cache, so serve in half precision on GPU
+        if torch.cuda.is_available():
+            self.dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+        else:
+            self.dtype = torch.float32
         self.tokenizer = AutoTokenizer.from_pretrained(SUMMARY_MODEL_PATH)
         
         defaults = UnlimiformerArguments()
@@ -31,12 +75,24 @@ class Summarizer():
             'gpu_datastore': defaults.gpu_datastore,
             'gpu_index': defaults.gpu_index
         }
-        model = AutoModelForSeq2SeqLM.from_pretrained(SUMMARY_MODEL_PATH).to(self.device)
+        model = AutoModelForSeq2SeqLM.from_pretrained(SUMMARY_MODEL_PATH, torch_dtype=self.dtype).to(self.device)
         self.model = Unlimiformer.convert_model(model, **unlimiformer_kwargs)
         self.model.eval()
         self.model.to(self.device)
-        
-    def resolve_multiple_mentions(self, document:str, targets: List):
+        self.model.config.eos_token_id=50118 # sets newline ("\n") token as EOS token to terminate generation
+        self.tokenizer.padding_side = "right" # Unlimiformer keeps the first window of every row as the regular encoder input
+        self._warmup()
+
+    def _warmup(self):
+        """
+        Run one dummy generation at startup so CUDA context creation, kernel selection and allocator growth
+        are paid before serving traffic instead of on the first request.
+        """
+        inputs = self.tokenizer(" ".join(["warmup"] * WARMUP_INPUT_LENGTH), return_tensors="pt", max_length=WARMUP_INPUT_LENGTH, truncation=True).to(self.device)
+        with torch.inference_mode():
+            self.model.generate(**inputs, **{**GENERATION_KWARGS, 'max_new_tokens': WARMUP_NEW_TOKENS})
+
+    def resolve_multiple_mentions(self, document:str, targets: List) -> Dict[int, str]:
         targets_dict = defaultdict(list)
 
         # Group targets by UUID
@@ -44,38 +100,94 @@ class Summarizer():
             targets_dict[target.target_uuid].append(target)
         
         # Get most common/longest mention for every UUID
+        resolved = {}
         for uuid, targets in targets_dict.items():
-            mentions = [document[target.span_start:target.span_end].strip() for target in targets]
-            # Sort list by length to return the longest mention if tie
-            mentions.sort(key=len, reverse=True)
-            # Get most common mention
-            targets_dict[uuid] = max(mentions, key=mentions.count) 
+            mention_counts = Counter(document[target.span_start:target.span_end].strip() for target in targets)
+            # Get most common mention, the longest one if tie
+            resolved[uuid] = max(mention_counts, key=lambda mention: (mention_counts[mention], len(mention)))
         
-        return targets_dict
+        return resolved
 
 
-    def generate_prompt(self, entity_list:List , entity:str, document:str):
+    def generate_prefix(self, entity_list:List , entity:str):
         entity_list.remove(entity)
         other_entities = "\n".join([f"[{idx+2}] {ent.strip()}" for idx, ent in enumerate(entity_list)])
-        prompt = f"[1] {entity.strip()}\n{other_entities}\ndocument: {document}"
-        return prompt
+        prefix = f"[1] {entity.strip()}\n{other_entities}"
+        return prefix
+
+    def _generate(self, prompt_ids: List[List[int]], forced_mentions: List[str]) -> List[str]:
+        inputs = self.tokenizer.pad({"input_ids": prompt_ids}, return_tensors="pt").to(self.device)
+        forced_prefix = TargetPrefixLogitsProcessor(
+            self.tokenizer(forced_mentions, add_special_tokens=False).input_ids,
+            num_beams=NUM_BEAMS,
+            start_len=1 if self.model.generation_config.forced_bos_token_id is None else 2)
+        with torch.inference_mode():
+            summary_ids = self.model.generate(**inputs, logits_processor=LogitsProcessorList([forced_prefix]), **GENERATION_KWARGS)
+        return self.tokenizer.batch_decode(summary_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False)
 
     def summarize(self, document: str, targets: List, ):
-        torch.cuda.empty_cache()
-        response = []
-        targets_dict = self.resolve_multiple_mentions(document, targets)
-        mentions = [mention for mention in targets_dict.values()]
-        for target_uuid, target_mention in targets_dict.items():
-            print(f"Target UUID: {target_uuid}, Mention: {target_mention}")
-            prompt = self.generate_prompt(mentions.copy(), target_mention, document)
-            # inputs = self.tokenizer(prompt, return_tensors="pt", max_length=1024, truncation=True).to(self.device)
-            inputs = self.tokenizer(prompt, return_tensors="pt", truncation=False).to(self.device)
-            self.model.config.eos_token_id=50118 # sets newline ("\n") token as EOS token to terminate generation
-            summary_ids = self.model.generate(**inputs, force_words_ids=self.tokenizer([f"[1] {target_mention}:"], add_special_tokens=False).input_ids, max_new_tokens=1024, num_beams=4, do_sample=False, encoder_repetition_penalty=1.5) # penalise if output token not seen in enconder input
-            summary = self.tokenizer.batch_decode(summary_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False)[0]
+        response = self.summarize_batch([(document, targets)])[0]
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def summarize_batch(self, requests: List[Tuple[str, List]]) -> List[Union[List[Dict], Exception]]:
+        """
+        Summarize the targets of several requests, with one generate call per document and MAX_BATCH_ROWS targets.
+
+        Args:
+            requests (list): (document, targets) pairs
+
+        Returns:
+            list: per request, in the same order as `requests`, its list of {"target_uuid", "summary"} dicts,
+                or the exception raised while summarizing its document
+        """
+        responses = [[] for _ in requests]
+        # Rows are grouped by document: prompts of one document share their chunks in the Unlimiformer encoder and need
+        # no padding, while mixing documents would pad the short ones and encode every row separately
+        document_rows = defaultdict(list) # document -> (request index, target uuid, prefix, forced mention) per row
+        for request_idx, (document, targets) in enumerate(requests):
             try:
-                ent, summ = summary.replace(" [", "\n[").split("\n")[0].replace("[1] ", "").split(":")
-                response.append({"target_uuid": target_uuid, "summary": summ.strip()}) 
+                targets_dict = self.resolve_multiple_mentions(document, targets)
+                mentions = [mention for mention in targets_dict.values()]
+                rows = []
+                for target_uuid, target_mention in targets_dict.items():
+                    print(f"Target UUID: {target_uuid}, Mention: {target_mention}")
+                    rows.append((request_idx, target_uuid, self.generate_prefix(mentions.copy(), target_mention), f"[1] {target_mention}:"))
             except Exception as e:
-                print(summary)
-        return response
\ No newline at end of file
+                responses[request_idx] = e
+                continue
+            if rows:
+                document_rows[document].extend(rows)
+
+        for document, rows in document_rows.items():
+            try:
+                document_responses = self._summarize_document(document, rows)
+            except Exception as e:
+                # e.g. out of memory on a long document: only the requests of this document fail, the others are kept
+                for request_idx, _, _, _ in rows:
+                    responses[request_idx] = e
+                continue
+            for request_idx, response in document_responses:
+                responses[request_idx].append(response)
+        return responses
+
+    def _summarize_document(self, document: str, rows: List[Tuple]) -> List[Tuple[int, Dict]]:
+        document_responses = []
+        # The document is the same in every prompt: tokenize it once and only tokenize the short entity prefixes per target
+        document_ids = self.tokenizer(f"\ndocument: {document}", add_special_tokens=False).input_ids
+        # Unlimiformer's memory grows linearly with the number of rows, so at most MAX_BATCH_ROWS go through at once
+        for start in range(0, len(rows), MAX_BATCH_ROWS):
+            batch_rows = rows[start:start + MAX_BATCH_ROWS]
+            prefix_ids = self.tokenizer([prefix for _, _, prefix, _ in batch_rows], add_special_tokens=False).input_ids
+            prompt_ids = [self.tokenizer.build_inputs_with_special_tokens(ids + document_ids) for ids in prefix_ids]
+            summaries = self._generate(prompt_ids, [forced_mention for _, _, _, forced_mention in batch_rows])
+            for (request_idx, target_uuid, _, forced_mention), summary in zip(batch_rows, summaries):
+                # The output starts with the forced prefix, which is stripped as a whole: mentions may contain ":"
+                prefix_start = summary.find(forced_mention)
+                if prefix_start == -1:
+                    print(summary)
+                    continue
+                match = SUMMARY_PATTERN.match(summary, prefix_start + len(forced_mention))
+                document_responses.append((request_idx, {"target_uuid": target_uuid, "summary": match["summ"].strip()}))
+        return document_responses
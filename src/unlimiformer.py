@@ -58,9 +58,11 @@ class Unlimiformer(Generic[ModelType]):
         self.is_first_test_decoding_step = False
         self.prev_tokens = None
         self.last_beam_idx = None
+        self.identity_beam_idx = None
         self.heatmap = None
         self.cur_decoder_layer_index = None
         self.datastore = None
+        self.attend_to_whole_prompt = False
 
         self.break_into(model)
 
@@ -330,7 +332,6 @@ class Unlimiformer(Generic[ModelType]):
         if self.use_datastore:
             self.datastore = DatastoreBatch(dim=self.model.config.hidden_size, batch_size=input_ids.shape[0], flat_index=self.flat_index, gpu_index=self.gpu_index)
             self.embeddings = []
-            torch.cuda.empty_cache()
         self.prompt_input_ids = input_ids
         self.input_ids = torch.tensor([], dtype=torch.long, device=input_ids.device)
         self.prompt_keys, self.prompt_values = None, None
@@ -346,6 +347,10 @@ class Unlimiformer(Generic[ModelType]):
             self.heatmap = torch.tensor([], dtype=torch.float, device=input_ids.device)
         self.generated_input_ids = torch.tensor([], dtype=torch.long, device=input_ids.device)
 
+        # when the whole input fits in the model window there is nothing to retrieve, so kNN scoring and top-k can be skipped
+        self.attend_to_whole_prompt = (not self.use_datastore) and (not self.save_heatmap) \
+            and self.specific_head is None and input_ids.shape[-1] <= self.actual_model_window_size
+
         self.prompt_keys = []
         self.prompt_values = []
         self.prompt_attention_mask = []
@@ -354,8 +359,16 @@ class Unlimiformer(Generic[ModelType]):
         for context_start_ind, context_end_ind, update_start_ind, update_end_ind in window_indices:
             chunk = input_ids[:, context_start_ind:context_end_ind]
             chunk_attention_mask = attention_mask[:, context_start_ind:context_end_ind]
-            hidden_states = self.model(chunk, attention_mask=chunk_attention_mask, labels=dummy_labels, return_dict=True)
+            # rows that only differ in their prompt prefix share the remaining document chunks:
+            # encode such a chunk once and broadcast it to the whole batch
+            is_shared_chunk = self.is_shared_chunk(chunk, chunk_attention_mask)
+            if is_shared_chunk:
+                hidden_states = self.model(chunk[:1], attention_mask=chunk_attention_mask[:1], labels=dummy_labels[:1], return_dict=True)
+            else:
+                hidden_states = self.model(chunk, attention_mask=chunk_attention_mask, labels=dummy_labels, return_dict=True)
             last_hidden = hidden_states.encoder_last_hidden_state # (batch, chunked_source_len, dim)
+            if is_shared_chunk:
+                last_hidden = last_hidden.expand(input_ids.shape[0], -1, -1)
             if self.use_datastore:
                 to_add = last_hidden[:, update_start_ind:update_end_ind].detach()
                 to_apply_mask = chunk_attention_mask[:, update_start_ind:update_end_ind]
@@ -372,6 +385,9 @@ class Unlimiformer(Generic[ModelType]):
                     self.process_key_value(layer_capturer) # (batch, head, time, dim)
                     for layer_capturer in self.activation_capturer
                 ] # list of pairs of (batch, head, time, dim)
+                if is_shared_chunk:
+                    layers_kv = [(key.expand(input_ids.shape[0], -1, -1, -1), value.expand(input_ids.shape[0], -1, -1, -1))
+                        for key, value in layers_kv]
 
                 # list of (batch, head, chunked_time, dim)
                 key = [layer[0][:, :, update_start_ind:update_end_ind] for layer in layers_kv]
@@ -394,6 +410,10 @@ class Unlimiformer(Generic[ModelType]):
             self.prompt_keys = torch.cat(self.prompt_keys, dim=-2) # (num_layers, batch, head, source_len, dim)
             self.prompt_values = torch.cat(self.prompt_values, dim=-2) # (num_layers, batch, head, source_len, dim)
             self.prompt_attention_mask = torch.cat(self.prompt_attention_mask, dim=-1) # (batch, source_len)
+            # the mask is fixed for the whole generation, so build the additive bias once instead of at every layer and step
+            self.prompt_attention_mask_to_add = ((1 - self.prompt_attention_mask) * -1e9).unsqueeze(1).unsqueeze(1) # (batch, 1, 1, source_len)
+            if self.exclude_attention and self.prompt_attention_mask_to_add.shape[-1] > self.actual_model_window_size:
+                self.prompt_attention_mask_to_add[..., :self.actual_model_window_size] -= 1e9
 
         if self.normalize:
             self.prompt_keys = torch.nn.functional.normalize(self.prompt_keys, dim=-1)
@@ -405,6 +425,11 @@ class Unlimiformer(Generic[ModelType]):
                 f'{self.tokenizer.decode(input_ids[0][self.actual_model_window_size:], skip_special_tokens=True)}')
             print()
 
+    def is_shared_chunk(self, chunk, chunk_attention_mask):
+        if chunk.shape[0] == 1:
+            return False
+        return bool((chunk == chunk[:1]).all() and (chunk_attention_mask == chunk_attention_mask[:1]).all())
+
     def chunked_encode_input(self, input_ids, attention_mask):
         long_inputs_encoded = []
         long_inputs_mask = []
@@ -468,6 +493,9 @@ class Unlimiformer(Generic[ModelType]):
                 results.append((cs, ce, us, ue))
             return results
 
+    def tracks_generated_ids(self):
+        return self.verbose or self.save_heatmap
+
     def pre_generate_hook(self, input_ids, **kwargs):
         self.reset_memory(input_ids, kwargs['attention_mask'])
         new_kwargs = kwargs
@@ -491,10 +519,12 @@ class Unlimiformer(Generic[ModelType]):
                 if kwargs.get('past_key_values') is None:
                     self.is_first_test_decoding_step = True
 
-                if input_ids is not None:
-                    self.input_ids = torch.cat([self.input_ids, input_ids[0]])
-                if kwargs.get('decoder_input_ids') is not None:
-                    self.generated_input_ids = torch.cat([self.generated_input_ids, kwargs['decoder_input_ids']], axis=-1)
+                # the generated tokens are only needed for printing, skip the per-step concatenation otherwise
+                if self.tracks_generated_ids():
+                    if input_ids is not None:
+                        self.input_ids = torch.cat([self.input_ids, input_ids[0]])
+                    if kwargs.get('decoder_input_ids') is not None:
+                        self.generated_input_ids = torch.cat([self.generated_input_ids, kwargs['decoder_input_ids']], axis=-1)
             
         result = self.original_forward_func(input_ids=input_ids, labels=labels, attention_mask=attention_mask, **kwargs)
         self.is_first_test_decoding_step = False
@@ -581,24 +611,21 @@ class Unlimiformer(Generic[ModelType]):
                 # this_layer_prompt_keys.unsqueeze(1):  (batch, 1, head, source_len, dim)
                 # query.unsqueeze(-1):             (batch, beam, head, dim, 1)
                 # attn_weights:  (batch, beam, head, source_len)
-                attn_weights = torch.matmul(this_layer_prompt_keys.unsqueeze(1)[:, :, self.head_nums], query.unsqueeze(-1)).squeeze(-1) 
-                # attn_weights = torch.matmul(query.unsqueeze(-2), this_layer_prompt_keys.unsqueeze(1)[:, :, self.head_nums]).squeeze(-2) 
-                prompt_attention_mask_to_add = (1 - self.prompt_attention_mask) * -1e9 # (batch, source_len)
-                prompt_attention_mask_to_add = prompt_attention_mask_to_add.unsqueeze(1).unsqueeze(1)
-                attn_weights += prompt_attention_mask_to_add # (batch, beam, head, source_len)
-                if self.exclude_attention and attn_weights.shape[-1] > self.actual_model_window_size:
-                    attn_weights[..., :self.actual_model_window_size] -= 1e9
-
-                # target_keys, target_values, topk = self.get_target_slices(output)
-                topk = min(self.actual_model_window_size, attn_weights.shape[-1])
-                top_key_scores, top_key_indices = torch.topk(attn_weights, k=topk, dim=-1, sorted=True) # (batch, beam, head, trunc_source)
-                if self.save_heatmap:
-                    # heatrow: (beam, heads, source_len)
-                    heatrow = torch.zeros([top_key_indices.shape[1], top_key_indices.shape[2], this_layer_prompt_keys.shape[-2]], dtype=torch.float)
-                    heatrow = heatrow.scatter(index=top_key_indices[0], src=torch.ones_like(top_key_scores[0]), dim=-1)
-                    # heatrow = torch.nn.functional.softmax(heatrow, dim=-1)
-                    # self.heatmap: (beam, heads, targets, source_len)
-                    self.heatmap = torch.cat([self.heatmap, heatrow.unsqueeze(-2)], axis=-2)
+                if not self.attend_to_whole_prompt:
+                    attn_weights = torch.matmul(this_layer_prompt_keys.unsqueeze(1)[:, :, self.head_nums], query.unsqueeze(-1)).squeeze(-1) 
+                    # attn_weights = torch.matmul(query.unsqueeze(-2), this_layer_prompt_keys.unsqueeze(1)[:, :, self.head_nums]).squeeze(-2) 
+                    attn_weights += self.prompt_attention_mask_to_add # (batch, beam, head, source_len)
+
+                    # target_keys, target_values, topk = self.get_target_slices(output)
+                    topk = min(self.actual_model_window_size, attn_weights.shape[-1])
+                    top_key_scores, top_key_indices = torch.topk(attn_weights, k=topk, dim=-1, sorted=True) # (batch, beam, head, trunc_source)
+                    if self.save_heatmap:
+                        # heatrow: (beam, heads, source_len)
+                        heatrow = torch.zeros([top_key_indices.shape[1], top_key_indices.shape[2], this_layer_prompt_keys.shape[-2]], dtype=torch.float)
+                        heatrow = heatrow.scatter(index=top_key_indices[0], src=torch.ones_like(top_key_scores[0]), dim=-1)
+                        # heatrow = torch.nn.functional.softmax(heatrow, dim=-1)
+                        # self.heatmap: (beam, heads, targets, source_len)
+                        self.heatmap = torch.cat([self.heatmap, heatrow.unsqueeze(-2)], axis=-2)
 
             if self.test_datastore:
                 assert top_key_indices.shape == top_search_key_indices.shape
@@ -623,6 +650,10 @@ class Unlimiformer(Generic[ModelType]):
             # new_keys, new_values: (batch, beam, head, encoder_len, attn_dim)
             new_keys = torch.matmul(embeddings, k_weight) + k_bias.unsqueeze(0) # (beam, head, encoder_len, embed_dim)
             new_values = torch.matmul(embeddings, v_weight) + v_bias.unsqueeze(0) # (beam, head, encoder_len, embed_dim)
+        elif self.attend_to_whole_prompt:
+            # top-k would return every key anyway: attend to the whole memory in its original order
+            new_keys = this_layer_prompt_keys.unsqueeze(1).expand(-1, beam_size, -1, -1, -1) # (batch, beam, head, source_len, attn_dim)
+            new_values = this_layer_prompt_values.unsqueeze(1).expand(-1, beam_size, -1, -1, -1) # (batch, beam, head, source_len, attn_dim)
         else:
             # this_layer_prompt_keys:   (batch,       head, source_len, dim)
             # top_key_indices:          (batch, beam, head, trunc_source)
@@ -693,7 +724,14 @@ class Unlimiformer(Generic[ModelType]):
 
     def reorder_cache_hook(self, past, beam_idx):
         self.last_beam_idx = beam_idx
-        self.generated_input_ids = self.generated_input_ids[beam_idx]
+        # once beams settle they often keep their slots, which makes the per-layer gathers of the whole cache a no-op
+        if self.identity_beam_idx is None or self.identity_beam_idx.shape != beam_idx.shape \
+                or self.identity_beam_idx.device != beam_idx.device:
+            self.identity_beam_idx = torch.arange(beam_idx.shape[0], dtype=beam_idx.dtype, device=beam_idx.device)
+        if torch.equal(beam_idx, self.identity_beam_idx):
+            return past
+        if self.tracks_generated_ids():
+            self.generated_input_ids = self.generated_input_ids[beam_idx]
         for i, layer_prev_tokens in enumerate(self.prev_tokens):
             if layer_prev_tokens is not None:
                 self.prev_tokens[i] = layer_prev_tokens.flatten(0, 1)[beam_idx].reshape(layer_prev_tokens.shape)
@@ -705,6 +743,8 @@ class Unlimiformer(Generic[ModelType]):
     def convert_model(cls, model, *args, **kwargs):
         model_clone = AutoModelForSeq2SeqLM.from_config(model.config)
         model_clone.load_state_dict(model.state_dict())
+        # Cast after loading: the random init of from_config has no CPU half-precision kernels, and the cast is lossless
+        model_clone.to(model.dtype)
         type_to_class = {
             BartModel: UnlimiformerBART,
             BartForConditionalGeneration: UnlimiformerBART,
@@ -1,10 +1,10 @@
-import collections
+from collections.abc import MutableMapping
 import os
 from typing import Union, List, Dict
 import time
 
-from elasticsearch import Elasticsearch
-from elasticsearch.helpers import bulk, scan, streaming_bulk
+from elasticsearch import Elasticsearch, NotFoundError
+from elasticsearch.helpers import bulk, scan, parallel_bulk
 
 # Map common python types to ES Types
 TYPE_MAP = {
@@ -22,7 +22,40 @@ TYPE_MAP = {
     "numpy.ndarray": "dense_vector"
 }
 
-MAX_BULK_SIZE = 100
+# parallel_bulk settings used when ingesting documents
+BULK_THREAD_COUNT = 4
+BULK_CHUNK_SIZE = 500
+BULK_QUEUE_SIZE = 8
+
+
+def _build_mapping(map_dict: Dict) -> Dict:
+    """
+    Convert a mapping dictionary into an ES mapping in a single iterative walk, validating every type against TYPE_MAP
+
+    Args:
+        map_dict (dict): Mapping to be converted
+
+    Returns:
+        dict: ES mapping
+
+    Raises:
+        KeyError: if a type is not found in TYPE_MAP
+
+    """
+    mapping = {"properties": dict()}
+    stack = [(map_dict, mapping["properties"])]
+    while stack:
+        fields, properties = stack.pop()
+        for k, v in fields.items():
+            if isinstance(v, dict):
+                properties[k] = {"properties": dict()}
+                stack.append((v, properties[k]["properties"]))
+            elif isinstance(v, str) and v in TYPE_MAP:
+                properties[k] = {"type": TYPE_MAP[v]}
+            else:
+                print(f"'{v}' type for '{k}' NOT FOUND")
+                raise KeyError(v)
+    return mapping
 
 
 class DocManager():
@@ -36,8 +69,6 @@ class DocManager():
                                     verify_certs=False,
                                     basic_auth=(self.username, self.password), timeout=30, max_retries=10, retry_on_timeout=True)
 
-        self.consolidated_actions = []
-
     def _check_data_type(self, var, var_type):
         try:
             assert type(var) == var_type
@@ -45,28 +76,6 @@ class DocManager():
             return False
         return True
 
-    def _check_valid_values(self, map_dict: dict) -> int:
-        """
-        Traverse mapping dictionary to ensure that all types are valid types within TYPE_MAP
-
-        Args:
-            map_dict (dict): Mapping to be checked
-
-        Returns:
-            int: 0 if there is invalid types, 1 otherwise
-
-        """
-        ret_val = 1
-        for k, v in map_dict.items():
-            if isinstance(v, dict):
-                ret_val = self._check_valid_values(v)
-            else:
-                if not v in TYPE_MAP:
-                    print(f"'{v}' type for '{k}' NOT FOUND")
-                    return 0
-
-        return ret_val * 1
-
     def _traverse_map(self, map_dict: Dict) -> Dict:
         """
         Traverse mapping dictionary to convert data type into framework specific type
@@ -77,39 +86,29 @@ class DocManager():
         Returns:
             dict: updated mapping dictionary
 
-        """
-        dictionary = {"properties": dict()}
-        for k, v in map_dict.items():
-            if isinstance(v, dict):
-                dictionary['properties'][k] = self._traverse_map(v)
-            else:
-                dictionary['properties'][k] = {"type": TYPE_MAP[v]}
-        return dictionary
+        Raises:
+            KeyError: if a type in the mapping is not found in TYPE_MAP
 
-    def _flush(self):
-        errors = []
-        list_of_es_ids = []
-        for ok, item in streaming_bulk(self.client, self.consolidated_actions):
-            if not ok:
-                errors.append(item)
-            else:
-                list_of_es_ids.append(item['index']['_id'])
-        if len(errors) != 0:
-            print("List of faulty documents:", errors)
-        self.consolidated_actions = []  # Reset List
-        return list_of_es_ids
+        """
+        return _build_mapping(map_dict)
 
     def _flatten(self, d, parent_key='', sep='.'):
         """
         Flatten nested dictionary keys to dotted parameters because Elasticsearch. 
         """
         items = []
-        for k, v in d.items():
-            new_key = parent_key + sep + k if parent_key else k
-            if isinstance(v, collections.MutableMapping):
-                items.extend(self._flatten(v, new_key, sep=sep).items())
-            else:
+        # Depth-first over a stack of item iterators, so keys keep the order of the nested dict
+        stack = [(parent_key, iter(d.items()))]
+        while stack:
+            prefix, dict_items = stack[-1]
+            for k, v in dict_items:
+                new_key = f"{prefix}{sep}{k}" if prefix else k
+                if isinstance(v, MutableMapping):
+                    stack.append((new_key, iter(v.items())))
+                    break
                 items.append((new_key, v))
+            else:
+                stack.pop()
         return dict(items)
 
     def create_collection(self, collection_name: str, schema: Dict, custom_schema: bool = False) -> Dict:
@@ -139,10 +138,10 @@ class DocManager():
                 return {"response": f"{e}"}
             return {"response": "200"}
         else:
-            mapping_validity = self._check_valid_values(schema)
-            if not mapping_validity:
+            try:
+                updated_mapping = self._traverse_map(schema)
+            except KeyError:
                 return {"response": "KeyError: data type not found in TYPE_MAP"}
-            updated_mapping = self._traverse_map(schema)
             try:
                 self.client.indices.create(
                     index=collection_name, mappings=updated_mapping)
@@ -207,21 +206,29 @@ class DocManager():
                 except Exception as e:
                     return {"response": "id cannot be casted to String type. No documents uploaded.",
                             "error_doc": doc}
+        def _actions():
+            for doc in documents:
+                doc_copy = dict(doc)
+                action_dict = {}
+                action_dict['_op_type'] = 'index'
+                action_dict['_index'] = collection_name
+                if id_field != None:
+                    action_dict['_id'] = doc_copy[id_field]
+                    doc_copy.pop(id_field)
+                action_dict['_source'] = doc_copy
+                yield action_dict
+
+        # Stream the actions to ES over several threads instead of building and flushing fixed-size lists
         all_id = []
-        for doc in documents:
-            doc_copy = dict(doc)
-            action_dict = {}
-            action_dict['_op_type'] = 'index'
-            action_dict['_index'] = collection_name
-            if id_field != None:
-                action_dict['_id'] = doc_copy[id_field]
-                doc_copy.pop(id_field)
-            action_dict['_source'] = doc_copy
-            self.consolidated_actions.append(action_dict)
-            if len(self.consolidated_actions) == MAX_BULK_SIZE:
-                all_id = all_id+self._flush()
-
-        all_id = all_id+self._flush()
+        errors = []
+        for ok, item in parallel_bulk(self.client, _actions(), thread_count=BULK_THREAD_COUNT,
+                                      chunk_size=BULK_CHUNK_SIZE, queue_size=BULK_QUEUE_SIZE):
+            if not ok:
+                errors.append(item)
+            else:
+                all_id.append(item['index']['_id'])
+        if len(errors) != 0:
+            print("List of faulty documents:", errors)
 
         return {"response": "200", "ids": all_id}
 
@@ -243,11 +250,7 @@ class DocManager():
             return {"response": "Type of 'doc_id' is not str"}
 
         # Check for document's existence
-        search_result = self.client.search(index=collection_name, query={
-                                           "match": {"_id": doc_id}})
-        result_count = search_result['hits']['total']['value']
-
-        if result_count == 0:
+        if not self.client.exists(index=collection_name, id=doc_id):
             return {"response": f"Document '{doc_id}' not found!"}
 
         try:
@@ -278,32 +281,12 @@ class DocManager():
             return {"response": "Type of 'document' is not dict"}
 
         # Check for document's existence
-        search_result = self.client.search(index=collection_name, query={
-                                           "match": {"_id": doc_id}})
-        result_count = search_result['hits']['total']['value']
-
-        if result_count == 0:
+        if not self.client.exists(index=collection_name, id=doc_id):
             return {"response": f"Document '{doc_id}' not found, create document first"}
 
         try:
-            for key in document.keys():
-
-                q = {
-                    "script": {
-                        "source": f"ctx._source.{key}=params.infer",
-                        "params": {
-                            "infer": document[key]
-                        },
-                        "lang": "painless"
-                    },
-                    "query": {
-                        "match": {
-                            "_id": doc_id
-                        }
-                    }
-                }
-                resp = self.client.update_by_query(
-                    body=q, index=collection_name)
+            # Partial update of all fields on the known id in a single operation
+            resp = self.client.update(index=collection_name, id=doc_id, doc=document)
         except Exception as e:
             return {"response": f"{e.__class__.__name__}. Document Update failed"}
 
@@ -326,15 +309,13 @@ class DocManager():
         if not self._check_data_type(doc_id, str):
             return {"response": "Type of 'doc_id' is not str"}
 
-        # Check for document's existence
-        search_result = self.client.search(index=collection_name, query={
-                                           "match": {"_id": doc_id}})
-        result_count = search_result['hits']['total']['value']
-
-        if result_count == 0:
+        # Fetch the document by id, which also checks for its existence
+        try:
+            doc = self.client.get(index=collection_name, id=doc_id)
+        except NotFoundError:
             return {"response": f"Document '{doc_id}' not found!"}
 
-        doc_body = search_result['hits']['hits']
+        doc_body = [doc.body]
 
         return {"response": "200", "api_resp": doc_body}
 